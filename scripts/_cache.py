@@ -0,0 +1,47 @@
+"""
+Pickle cache for intermediate layers shared between the analysis scripts
+
+A cache file is only used while it is newer than every file it was built
+from, so re-running an earlier step (or replacing the input data)
+invalidates it automatically. Settings that shape the cached object
+(columns read, target CRS, ...) are stored with it as a key and must match
+on load.
+
+Author: Bazen Haile
+"""
+
+import os
+import pickle
+
+
+def load_cache(cache_file, source_files, key=None):
+    """
+    Load a pickled object if the cache exists, is newer than all sources
+    and was saved with the same key
+    Returns: cached object, or None if the cache is missing or stale
+    """
+    if not os.path.exists(cache_file):
+        return None
+
+    cache_mtime = os.path.getmtime(cache_file)
+    for path in source_files:
+        if not os.path.exists(path) or os.path.getmtime(path) > cache_mtime:
+            return None
+
+    with open(cache_file, 'rb') as f:
+        cached = pickle.load(f)
+
+    # Caches written with other settings (or by an older version) are stale
+    if not isinstance(cached, dict) or cached.get('key') != key or 'data' not in cached:
+        return None
+    return cached['data']
+
+
+def save_cache(cache_file, obj, key=None):
+    """
+    Pickle an object together with its key to the cache file
+    (creates the cache directory)
+    """
+    os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+    with open(cache_file, 'wb') as f:
+        pickle.dump({'key': key, 'data': obj}, f, protocol=pickle.HIGHEST_PROTOCOL)
@@ -0,0 +1,73 @@
+"""
+Cached CRS transformations shared by the analysis scripts
+
+Building a pyproj Transformer is the expensive part of reprojecting a
+small layer, so one transformer is kept per (source, target) CRS pair and
+reused by every layer that needs the same conversion.
+
+Author: Bazen Haile
+"""
+
+from functools import lru_cache
+
+import geopandas as gpd
+import numpy as np
+import pyproj
+import shapely
+
+
+@lru_cache(maxsize=128)
+def TransformerFromCRS(src_wkt, dst_wkt, always_xy):
+    """
+    Return a (cached) pyproj Transformer between two CRS given as WKT
+    """
+    return pyproj.Transformer.from_crs(src_wkt, dst_wkt, always_xy=always_xy)
+
+
+def _is_simple_points(geoms):
+    """
+    True if every geometry is a non-empty 2D Point
+    """
+    return bool(len(geoms)
+                and (shapely.get_type_id(geoms) == 0).all()
+                and not shapely.is_empty(geoms).any()
+                and not shapely.has_z(geoms).any())
+
+
+def to_crs(gdf, crs):
+    """
+    Reproject a GeoDataFrame to `crs` using a cached Transformer
+    Layers already in `crs` are returned without touching the coordinates
+    Returns: new GeoDataFrame (same columns, geometry in the target CRS)
+    """
+    if gdf.crs is None:
+        raise ValueError("Cannot transform naive geometries. "
+                         "Please set a crs on the object first.")
+
+    target_crs = pyproj.CRS.from_user_input(crs)
+
+    # Already in the target CRS - nothing to transform
+    if gdf.crs.equals(target_crs):
+        return gdf.copy(deep=False)
+
+    transformer = TransformerFromCRS(gdf.crs.to_wkt(), target_crs.to_wkt(), True)
+
+    def transform_coords(coords):
+        return np.column_stack(transformer.transform(*coords.T))
+
+    geoms = gdf.geometry.to_numpy()
+
+    if _is_simple_points(geoms):
+        # Point layers (EGMS): rebuild all points in one bulk constructor call
+        x, y = transformer.transform(shapely.get_x(geoms), shapely.get_y(geoms))
+        geoms = shapely.points(np.column_stack([x, y]))
+    else:
+        # Transform 3D geometries with their Z so it is kept (as GeoDataFrame.to_crs does)
+        geoms = geoms.copy()
+        has_z = shapely.has_z(geoms)
+        geoms[~has_z] = shapely.transform(geoms[~has_z], transform_coords)
+        geoms[has_z] = shapely.transform(geoms[has_z], transform_coords, include_z=True)
+
+    result = gdf.copy()
+    result.geometry = gpd.GeoSeries(geoms, index=gdf.index, crs=target_crs)
+    return result
@@ -7,13 +7,27 @@ Author: Bazen Haile
 Date: December 2024
 """
 
+import argparse
 import geopandas as gpd
+import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from matplotlib.colors import LinearSegmentedColormap
+from matplotlib.colors import LinearSegmentedColormap, Normalize
 import contextily as ctx
 import numpy as np
+import shapely
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+# Optional: rasterize dense point layers instead of drawing every marker
+try:
+    import datashader as ds
+    import datashader.transfer_functions as tf
+except ImportError:
+    ds = None
+
+from _cache import load_cache
+from _transformer import to_crs
 
 print("="*70)
 print("CREATING INFRASTRUCTURE ANALYSIS MAPS")
@@ -29,6 +43,7 @@ BASE_PATH = "/Users/BazenHaile/SNAP_2025/Dublin_EGMS_Ground_velocity/Dublin_EGMS
 RAILWAYS_POINTS = f"{BASE_PATH}/results/spatial_analysis/railways_points.gpkg"
 ROADS_POINTS = f"{BASE_PATH}/results/spatial_analysis/roads_points.gpkg"
 HARBOUR_POINTS = f"{BASE_PATH}/results/spatial_analysis/harbour_points.gpkg"
+POINT_COLUMNS = ['velocity']
 
 RAILWAYS_BUFFER = f"{BASE_PATH}/results/buffers/railways_buffer_dissolved.gpkg"
 ROADS_BUFFER = f"{BASE_PATH}/results/buffers/roads_buffer_dissolved.gpkg"
@@ -41,9 +56,24 @@ HARBOUR_POLY = f"{BASE_PATH}/data/infrastructure/clipped infrastructure/Dublin_H
 # Output directory
 OUTPUT_DIR = f"{BASE_PATH}/results/figures/python_maps"
 
+# Pickle cache of the dissolved buffers (written by step 1)
+BUFFERS_CACHE = f"{BASE_PATH}/.cache/buffers.pkl"
+
 # Map settings
-DPI = 300
+parser = argparse.ArgumentParser(description="Create infrastructure analysis maps")
+parser.add_argument('--dpi', type=int, default=150,
+                    help="Resolution for draft maps (default: 150)")
+parser.add_argument('--final', action='store_true',
+                    help="Publication quality maps (300 DPI)")
+args = parser.parse_args()
+
+DPI = 300 if args.final else args.dpi
+PNG_OPTIONS = {} if args.final else {'compress_level': 1}  # Fast PNG encoding for drafts
 FIGSIZE = (12, 10)
+POINT_SIZE = 30  # EGMS marker area (points^2)
+SIMPLIFY_TOLERANCE = 5.0  # Buffer/polygon outline simplification (map units, m)
+DATASHADER_MIN_POINTS = 1000  # Rasterize point layers larger than this (if datashader is installed)
+EARTH_RADIUS = 6378137.0  # Web Mercator sphere radius (m), for basemap zoom levels
 
 #=============================================================================
 # LOAD DATA
@@ -52,20 +82,31 @@ FIGSIZE = (12, 10)
 print("\n📂 Loading data...")
 print("-" * 70)
 
-# Load points
-railways_pts = gpd.read_file(RAILWAYS_POINTS)
-roads_pts = gpd.read_file(ROADS_POINTS)
-harbour_pts = gpd.read_file(HARBOUR_POINTS)
-
-# Load buffers
-railways_buf = gpd.read_file(RAILWAYS_BUFFER)
-roads_buf = gpd.read_file(ROADS_BUFFER)
-harbour_buf = gpd.read_file(HARBOUR_BUFFER)
-
-# Load infrastructure
-railways_line = gpd.read_file(RAILWAYS_LINE)
-roads_line = gpd.read_file(ROADS_LINE)
-harbour_poly = gpd.read_file(HARBOUR_POLY)
+# Reuse the dissolved buffers cached by step 1 while they are up to date
+buffers = load_cache(BUFFERS_CACHE, [RAILWAYS_BUFFER, ROADS_BUFFER, HARBOUR_BUFFER])
+
+# Load points, buffers and infrastructure in parallel
+# (pyogrio releases the GIL while reading)
+with ThreadPoolExecutor(max_workers=3) as executor:
+    # Points: velocity is the only attribute the maps use
+    points = executor.map(
+        lambda path: gpd.read_file(path, engine='pyogrio', columns=POINT_COLUMNS, use_arrow=True),
+        [RAILWAYS_POINTS, ROADS_POINTS, HARBOUR_POINTS])
+    if buffers is None:
+        buffers = executor.map(
+            lambda path: gpd.read_file(path, engine='pyogrio', use_arrow=True),
+            [RAILWAYS_BUFFER, ROADS_BUFFER, HARBOUR_BUFFER])
+    infrastructure = executor.map(
+        lambda path: gpd.read_file(path, engine='pyogrio', use_arrow=True),
+        [RAILWAYS_LINE, ROADS_LINE, HARBOUR_POLY])
+
+    railways_pts, roads_pts, harbour_pts = points
+    railways_buf, roads_buf, harbour_buf = buffers
+    railways_line, roads_line, harbour_poly = infrastructure
+
+# Velocities only need ~0.1 mm/yr precision: float32 halves the bytes scanned
+for pts in (railways_pts, roads_pts, harbour_pts):
+    pts['velocity'] = pts['velocity'].astype(np.float32)
 
 print(f"✅ Railways: {len(railways_pts):,} points")
 print(f"✅ Roads: {len(roads_pts):,} points")
@@ -73,17 +114,17 @@ print(f"✅ Harbour: {len(harbour_pts):,} points")
 
 # Convert all to Web Mercator (EPSG:3857) for basemap
 print("\n🗺️  Converting to Web Mercator for basemap...")
-railways_pts = railways_pts.to_crs(epsg=3857)
-roads_pts = roads_pts.to_crs(epsg=3857)
-harbour_pts = harbour_pts.to_crs(epsg=3857)
+railways_pts = to_crs(railways_pts, 3857)
+roads_pts = to_crs(roads_pts, 3857)
+harbour_pts = to_crs(harbour_pts, 3857)
 
-railways_buf = railways_buf.to_crs(epsg=3857)
-roads_buf = roads_buf.to_crs(epsg=3857)
-harbour_buf = harbour_buf.to_crs(epsg=3857)
+railways_buf = to_crs(railways_buf, 3857)
+roads_buf = to_crs(roads_buf, 3857)
+harbour_buf = to_crs(harbour_buf, 3857)
 
-railways_line = railways_line.to_crs(epsg=3857)
-roads_line = roads_line.to_crs(epsg=3857)
-harbour_poly = harbour_poly.to_crs(epsg=3857)
+railways_line = to_crs(railways_line, 3857)
+roads_line = to_crs(roads_line, 3857)
+harbour_poly = to_crs(harbour_poly, 3857)
 
 print("✅ All data converted to EPSG:3857")
 
@@ -96,27 +137,80 @@ colors = ['#d73027', '#fc8d59', '#fee08b', '#d9ef8b', '#91cf60', '#1a9850']
 n_bins = 100
 cmap = LinearSegmentedColormap.from_list('RdYlGn', colors, N=n_bins)
 
+# Precomputed RGBA lookup table (256 entries) for coloring points directly
+color_lut = cmap(np.linspace(0, 1, 256))
+
 #=============================================================================
 # MAPPING FUNCTION
 #=============================================================================
 
-def create_infrastructure_map(points_gdf, buffer_gdf, infra_gdf, 
-                              title, filename, infra_type):
+def rasterize_points(ax, xs, ys, velocities, vmin, vmax):
+    """
+    Aggregate dense EGMS points into a pixel grid with datashader
+    (mean velocity per pixel) and draw the result as a single image
+    Call once the figure layout is final: the canvas covers the current axes
+    limits with one canvas pixel per output pixel at DPI
+    """
+    ax.apply_aspect()  # settle the equal-aspect axes box before measuring it
+    xlim, ylim = ax.get_xlim(), ax.get_ylim()
+    bbox = ax.get_window_extent()
+    scale = DPI / ax.figure.dpi
+    width = max(int(round(bbox.width * scale)), 1)
+    height = max(int(round(bbox.height * scale)), 1)
+
+    canvas = ds.Canvas(plot_width=width, plot_height=height,
+                       x_range=xlim, y_range=ylim)
+    df = pd.DataFrame({'x': xs, 'y': ys, 'velocity': velocities})
+    # Points without a velocity are skipped by the mean aggregation
+    agg = canvas.points(df, 'x', 'y', agg=ds.mean('velocity'))
+    # Grow each pixel to roughly the radius of a scatter marker at DPI,
+    # with a thin black rim standing in for the scatter marker outline
+    radius_px = max(int(round(np.sqrt(POINT_SIZE) / 2 * DPI / 72)), 1)
+    outline_px = max(int(round(0.3 * DPI / 72)), 1)
+    fill = tf.spread(tf.shade(agg, cmap=cmap, how='linear', span=(vmin, vmax)),
+                     px=radius_px)
+    outline = tf.spread(tf.shade(agg, cmap=['black'], min_alpha=255),
+                        px=radius_px + outline_px)
+    img = tf.stack(outline, fill)
+
+    # Image covers exactly the current view; keep the limits as they are
+    ax.imshow(img.to_pil(), extent=(*xlim, *ylim), origin='upper',
+              interpolation='nearest', alpha=0.8, zorder=1)
+    ax.set_xlim(xlim)
+    ax.set_ylim(ylim)
+
+
+def create_infrastructure_map(fig, points_gdf, buffer_gdf, infra_gdf, 
+                              title, filename, infra_type, basemap=None):
     """
     Create a professional map for one infrastructure type
     
     Parameters:
+    - fig: Figure to draw on (cleared first, reused across maps)
     - points_gdf: GeoDataFrame with EGMS points
     - buffer_gdf: GeoDataFrame with buffer zone
     - infra_gdf: GeoDataFrame with infrastructure (line or polygon)
     - title: Map title
     - filename: Output filename
     - infra_type: 'line' or 'polygon'
+    - basemap: (image, extent) from ctx.bounds2img, or None
     """
     print(f"\n🗺️  Creating {title}...")
     
-    # Create figure
-    fig, ax = plt.subplots(1, 1, figsize=FIGSIZE)
+    # Reset the shared figure (drops the previous map's axes and colorbar)
+    fig.clf()
+    ax = fig.add_subplot(1, 1, 1)
+    
+    # Drop vertices that are below pixel size at map scale before plotting
+    buffer_gdf = gpd.GeoDataFrame(
+        geometry=shapely.simplify(buffer_gdf.geometry.to_numpy(), SIMPLIFY_TOLERANCE,
+                                  preserve_topology=False),
+        crs=buffer_gdf.crs)
+    if infra_type == 'polygon':
+        infra_gdf = gpd.GeoDataFrame(
+            geometry=shapely.simplify(infra_gdf.geometry.to_numpy(), SIMPLIFY_TOLERANCE,
+                                      preserve_topology=False),
+            crs=infra_gdf.crs)
     
     # Plot buffer zone (light gray, dashed outline)
     buffer_gdf.boundary.plot(ax=ax, color='black', linewidth=1.5, 
@@ -130,23 +224,45 @@ def create_infrastructure_map(points_gdf, buffer_gdf, infra_gdf,
         infra_gdf.plot(ax=ax, facecolor='lightblue', edgecolor='darkblue', 
                        linewidth=1.5, alpha=0.3, label='Infrastructure')
     
-    # Plot EGMS points colored by velocity
-    points_gdf.plot(ax=ax, column='velocity', cmap=cmap,
-                    markersize=30, alpha=0.8, 
-                    edgecolor='black', linewidth=0.3,
-                    legend=True,
-                    legend_kwds={'label': 'Velocity (mm/yr)',
-                                'orientation': 'horizontal',
-                                'shrink': 0.8,
-                                'pad': 0.05})
-    
-    # Add basemap
-    try:
-        ctx.add_basemap(ax, source=ctx.providers.OpenStreetMap.Mapnik, 
-                       alpha=0.6, attribution=False)
+    # Plot EGMS points colored by velocity (one PathCollection for all points,
+    # or one datashader image for dense layers)
+    xs = points_gdf.geometry.x.to_numpy()
+    ys = points_gdf.geometry.y.to_numpy()
+    velocities = points_gdf['velocity'].to_numpy()
+    rasterize = ds is not None and len(points_gdf) > DATASHADER_MIN_POINTS
+    if rasterize:
+        # Reserve the points' extent as scatter would; the image itself is
+        # drawn after the layout is final so it maps 1:1 to output pixels
+        vmin, vmax = np.nanmin(velocities), np.nanmax(velocities)
+        ax.update_datalim([(xs.min(), ys.min()), (xs.max(), ys.max())])
+        ax.autoscale_view()
+        sc = plt.cm.ScalarMappable(norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap)
+    else:
+        # Index the color table with uint8 velocity bins instead of letting
+        # matplotlib normalize and interpolate every value (points without a
+        # velocity are left out, as GeoDataFrame.plot does)
+        valid = ~np.isnan(velocities)
+        vmin, vmax = np.nanmin(velocities), np.nanmax(velocities)
+        span = (vmax - vmin) or 1.0
+        bins = np.clip((velocities[valid] - vmin) / span * 255, 0, 255).astype(np.uint8)
+        ax.scatter(xs[valid], ys[valid], c=color_lut[bins],
+                   s=POINT_SIZE, alpha=0.8,
+                   edgecolor='black', linewidths=0.3)
+        sc = plt.cm.ScalarMappable(norm=Normalize(vmin=vmin, vmax=vmax), cmap=cmap)
+    fig.colorbar(sc, ax=ax, orientation='horizontal',
+                 shrink=0.8, pad=0.05, label='Velocity (mm/yr)')
+    
+    # Add basemap (tiles fetched ahead of time, keep this map's extent)
+    if basemap is not None:
+        basemap_img, basemap_extent = basemap
+        xlim, ylim = ax.get_xlim(), ax.get_ylim()
+        ax.imshow(basemap_img, extent=basemap_extent, alpha=0.6,
+                  interpolation='bilinear', zorder=0)
+        ax.set_xlim(xlim)
+        ax.set_ylim(ylim)
         print("  ✅ Basemap added")
-    except Exception as e:
-        print(f"  ⚠️  Could not add basemap: {e}")
+    else:
+        print("  ⚠️  Basemap not available")
     
     # Set title and labels
     ax.set_title(title, fontsize=16, fontweight='bold', pad=20)
@@ -155,10 +271,16 @@ def create_infrastructure_map(points_gdf, buffer_gdf, infra_gdf,
     
     # Add statistics text box
     n_points = len(points_gdf)
-    mean_vel = points_gdf['velocity'].mean()
-    median_vel = points_gdf['velocity'].median()
-    pct_stable = ((points_gdf['velocity'] >= -2) & 
-                  (points_gdf['velocity'] <= 2)).sum() / n_points * 100
+    sorted_vel = np.sort(velocities[~np.isnan(velocities)])
+    n_valid = len(sorted_vel)
+    if n_valid > 0:
+        mean_vel = sorted_vel.mean(dtype=np.float64)
+        median_vel = (sorted_vel[(n_valid - 1) // 2] + sorted_vel[n_valid // 2]) / 2
+    else:
+        mean_vel = median_vel = np.nan
+    n_stable = (np.searchsorted(sorted_vel, 2, side='right') -
+                np.searchsorted(sorted_vel, -2, side='left'))
+    pct_stable = n_stable / n_points * 100
     
     stats_text = f"""Analysis Results:
     Points: {n_points:,}
@@ -180,13 +302,15 @@ def create_infrastructure_map(points_gdf, buffer_gdf, infra_gdf,
                 xycoords=ax.transAxes)
     
     # Tight layout
-    plt.tight_layout()
+    fig.tight_layout()
+    
+    if rasterize:
+        rasterize_points(ax, xs, ys, velocities, vmin, vmax)
     
     # Save
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     output_path = os.path.join(OUTPUT_DIR, filename)
-    plt.savefig(output_path, dpi=DPI, bbox_inches='tight')
-    plt.close()
+    fig.savefig(output_path, dpi=DPI, bbox_inches='tight', pil_kwargs=PNG_OPTIONS)
     
     print(f"  ✅ Saved: {output_path}")
     
@@ -200,30 +324,88 @@ print("\n" + "="*70)
 print("GENERATING MAPS")
 print("="*70)
 
+def map_extent(*layers):
+    """
+    Web Mercator extent of a map: its layers plus the default axes margins
+    Returns: (west, south, east, north)
+    """
+    bounds = np.vstack([gdf.total_bounds for gdf in layers])
+    west, south = bounds[:, :2].min(axis=0)
+    east, north = bounds[:, 2:].max(axis=0)
+    pad_x = (east - west) * plt.rcParams['axes.xmargin']
+    pad_y = (north - south) * plt.rcParams['axes.ymargin']
+    return west - pad_x, south - pad_y, east + pad_x, north + pad_y
+
+
+def auto_zoom(west, south, east, north):
+    """
+    Tile zoom level contextily picks with zoom='auto' for a Web Mercator extent
+    Returns: int zoom level
+    """
+    # Same rule as contextily: enough tiles to span the extent in lon/lat degrees
+    lon = np.degrees(np.array([west, east]) / EARTH_RADIUS)
+    lat = np.degrees(2 * np.arctan(np.exp(np.array([south, north]) / EARTH_RADIUS)) - np.pi / 2)
+    return int(min(np.ceil(np.log2(720 / (lon[1] - lon[0]))),
+                   np.ceil(np.log2(720 / (lat[1] - lat[0])))))
+
+
+# Each map gets the zoom level it would get on its own; tiles are fetched
+# once per zoom level for the combined extent of the maps using it
+print("\n🧱 Fetching basemap tiles...")
+map_extents = {
+    'Railways': map_extent(railways_pts, railways_buf, railways_line),
+    'Roads': map_extent(roads_pts, roads_buf, roads_line),
+    'Harbour': map_extent(harbour_pts, harbour_buf, harbour_poly),
+}
+map_zooms = {name: auto_zoom(*extent) for name, extent in map_extents.items()}
+
+basemaps = {}
+for zoom in sorted(set(map_zooms.values())):
+    names = [name for name, z in map_zooms.items() if z == zoom]
+    extents = np.array([map_extents[name] for name in names])
+    west, south = extents[:, :2].min(axis=0)
+    east, north = extents[:, 2:].max(axis=0)
+    try:
+        basemap = ctx.bounds2img(west, south, east, north, zoom=zoom,
+                                 source=ctx.providers.OpenStreetMap.Mapnik)
+        print(f"  ✅ Zoom {zoom} tiles fetched ({', '.join(names)})")
+    except Exception as e:
+        basemap = None
+        print(f"  ⚠️  Could not fetch basemap: {e}")
+    basemaps.update(dict.fromkeys(names, basemap))
+
+# One figure for all three maps (cleared between maps)
+fig = plt.figure(figsize=FIGSIZE)
+
 # Map 1: Railways
 map1 = create_infrastructure_map(
-    railways_pts, railways_buf, railways_line,
+    fig, railways_pts, railways_buf, railways_line,
     title="Dublin Railways - Ground Motion Analysis (2019-2023)\n719 EGMS Measurement Points",
     filename="map_01_railways_analysis.png",
-    infra_type='line'
+    infra_type='line',
+    basemap=basemaps['Railways']
 )
 
 # Map 2: Roads
 map2 = create_infrastructure_map(
-    roads_pts, roads_buf, roads_line,
+    fig, roads_pts, roads_buf, roads_line,
     title="Dublin Roads - Ground Motion Analysis (2019-2023)\n3,964 EGMS Measurement Points",
     filename="map_02_roads_analysis.png",
-    infra_type='line'
+    infra_type='line',
+    basemap=basemaps['Roads']
 )
 
 # Map 3: Harbour
 map3 = create_infrastructure_map(
-    harbour_pts, harbour_buf, harbour_poly,
+    fig, harbour_pts, harbour_buf, harbour_poly,
     title="Dublin Port - Ground Motion Analysis (2019-2023)\n128 EGMS Measurement Points",
     filename="map_03_harbour_analysis.png",
-    infra_type='polygon'
+    infra_type='polygon',
+    basemap=basemaps['Harbour']
 )
 
+plt.close(fig)
+
 #=============================================================================
 # SUMMARY
 #=============================================================================
@@ -7,7 +7,12 @@ Author: Bazen Haile
 """
 
 import geopandas as gpd
+import shapely
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from _cache import save_cache
+from _transformer import to_crs
 
 print("="*70)
 print("STEP 1: CREATE BUFFERS AROUND INFRASTRUCTURE")
@@ -27,10 +32,14 @@ HARBOUR_FILE = f"{BASE_PATH}/data/infrastructure/clipped infrastructure/Dublin_H
 # Output directory
 OUTPUT_DIR = f"{BASE_PATH}/results/buffers"
 
+# Pickle cache of the dissolved buffers (reused by step 2 and the maps)
+BUFFERS_CACHE = f"{BASE_PATH}/.cache/buffers.pkl"
+
 # Buffer distances (in meters)
 BUFFER_RAILWAYS = 50  # 50 meters for railways
 BUFFER_ROADS = 30     # 30 meters for roads
 BUFFER_HARBOUR = 0    # No buffer for harbour (use boundary as-is)
+BUFFER_QUAD_SEGS = 16 # Segments per quarter circle (GeoPandas default)
 
 #=============================================================================
 # STEP 1: LOAD INFRASTRUCTURE
@@ -39,22 +48,20 @@ BUFFER_HARBOUR = 0    # No buffer for harbour (use boundary as-is)
 print("\n📂 Loading infrastructure files...")
 print("-" * 70)
 
-# Load roads
-print("Loading roads...")
-roads = gpd.read_file(ROADS_FILE)
+# Load roads, railways and harbour in parallel (pyogrio releases the GIL while reading)
+print("Loading roads, railways and harbour...")
+with ThreadPoolExecutor(max_workers=3) as executor:
+    roads, railways, harbour = executor.map(
+        lambda path: gpd.read_file(path, engine='pyogrio', use_arrow=True),
+        [ROADS_FILE, RAILS_FILE, HARBOUR_FILE])
+
 print(f"  ✅ Loaded {len(roads):,} road features")
 print(f"  📍 CRS: {roads.crs}")
 
-# Load railways
-print("\nLoading railways...")
-railways = gpd.read_file(RAILS_FILE)
-print(f"  ✅ Loaded {len(railways):,} railway features")
+print(f"\n  ✅ Loaded {len(railways):,} railway features")
 print(f"  📍 CRS: {railways.crs}")
 
-# Load harbour
-print("\nLoading harbour...")
-harbour = gpd.read_file(HARBOUR_FILE)
-print(f"  ✅ Loaded {len(harbour):,} harbour features")
+print(f"\n  ✅ Loaded {len(harbour):,} harbour features")
 print(f"  📍 CRS: {harbour.crs}")
 
 #=============================================================================
@@ -68,9 +75,9 @@ print("ITM is the official Irish coordinate system - 1 meter = exactly 1 meter")
 
 TARGET_CRS = "EPSG:2157"
 
-roads_itm = roads.to_crs(TARGET_CRS)
-railways_itm = railways.to_crs(TARGET_CRS)
-harbour_itm = harbour.to_crs(TARGET_CRS)
+roads_itm = to_crs(roads, TARGET_CRS)
+railways_itm = to_crs(railways, TARGET_CRS)
+harbour_itm = to_crs(harbour, TARGET_CRS)
 
 print(f"✅ All layers converted to {TARGET_CRS}")
 
@@ -84,7 +91,8 @@ print("-" * 70)
 # Railways buffer: 50 meters
 print(f"\n1. Railways buffer ({BUFFER_RAILWAYS}m)...")
 railways_buffer = railways_itm.copy()
-railways_buffer['geometry'] = railways_itm.buffer(BUFFER_RAILWAYS)
+railways_buffer['geometry'] = shapely.buffer(railways_itm.geometry.to_numpy(), BUFFER_RAILWAYS,
+                                            quad_segs=BUFFER_QUAD_SEGS)
 railways_buffer['infra_type'] = 'Railways'
 railways_buffer['buffer_m'] = BUFFER_RAILWAYS
 print(f"   ✅ Created {BUFFER_RAILWAYS}m buffer around {len(railways_buffer)} railway features")
@@ -92,7 +100,8 @@ print(f"   ✅ Created {BUFFER_RAILWAYS}m buffer around {len(railways_buffer)} r
 # Roads buffer: 30 meters
 print(f"\n2. Roads buffer ({BUFFER_ROADS}m)...")
 roads_buffer = roads_itm.copy()
-roads_buffer['geometry'] = roads_itm.buffer(BUFFER_ROADS)
+roads_buffer['geometry'] = shapely.buffer(roads_itm.geometry.to_numpy(), BUFFER_ROADS,
+                                         quad_segs=BUFFER_QUAD_SEGS)
 roads_buffer['infra_type'] = 'Roads'
 roads_buffer['buffer_m'] = BUFFER_ROADS
 print(f"   ✅ Created {BUFFER_ROADS}m buffer around {len(roads_buffer)} road features")
@@ -112,9 +121,24 @@ print("\n🔄 Dissolving buffers (merging overlaps)...")
 print("-" * 70)
 print("This combines all railway buffers into ONE zone, all road buffers into ONE zone, etc.")
 
-railways_dissolved = railways_buffer.dissolve(by='infra_type')
-roads_dissolved = roads_buffer.dissolve(by='infra_type')
-harbour_dissolved = harbour_buffer.dissolve(by='infra_type')
+def dissolve_line_buffer(buffer_gdf, lines_gdf, distance):
+    """
+    Dissolve line buffers into one zone by merging the lines first and
+    buffering the merged geometry once (same zone, far less polygon union work)
+    Returns: GeoDataFrame with one row per infra_type, like dissolve()
+    """
+    attributes = buffer_gdf.drop(columns=buffer_gdf.geometry.name).groupby('infra_type').first()
+    merged_lines = shapely.union_all(lines_gdf.geometry.to_numpy())
+    zone = shapely.buffer(merged_lines, distance, quad_segs=BUFFER_QUAD_SEGS)
+    return gpd.GeoDataFrame(attributes, geometry=[zone], crs=lines_gdf.crs)
+
+# Railways and roads in parallel (GEOS releases the GIL in union/buffer)
+with ThreadPoolExecutor(max_workers=2) as executor:
+    railways_future = executor.submit(dissolve_line_buffer, railways_buffer, railways_itm, BUFFER_RAILWAYS)
+    roads_future = executor.submit(dissolve_line_buffer, roads_buffer, roads_itm, BUFFER_ROADS)
+    harbour_dissolved = harbour_buffer.dissolve(by='infra_type')
+    railways_dissolved = railways_future.result()
+    roads_dissolved = roads_future.result()
 
 print("✅ Buffers dissolved")
 print(f"   Railways: {len(railways_buffer)} features → 1 dissolved zone")
@@ -136,9 +160,9 @@ railways_file = f"{OUTPUT_DIR}/railways_buffer_50m.gpkg"
 roads_file = f"{OUTPUT_DIR}/roads_buffer_30m.gpkg"
 harbour_file = f"{OUTPUT_DIR}/harbour_boundary.gpkg"
 
-railways_buffer.to_file(railways_file, driver='GPKG')
-roads_buffer.to_file(roads_file, driver='GPKG')
-harbour_buffer.to_file(harbour_file, driver='GPKG')
+railways_buffer.to_file(railways_file, driver='GPKG', engine='pyogrio', use_arrow=True)
+roads_buffer.to_file(roads_file, driver='GPKG', engine='pyogrio', use_arrow=True)
+harbour_buffer.to_file(harbour_file, driver='GPKG', engine='pyogrio', use_arrow=True)
 
 print(f"✅ Railways buffer: {railways_file}")
 print(f"✅ Roads buffer: {roads_file}")
@@ -149,14 +173,18 @@ railways_dissolved_file = f"{OUTPUT_DIR}/railways_buffer_dissolved.gpkg"
 roads_dissolved_file = f"{OUTPUT_DIR}/roads_buffer_dissolved.gpkg"
 harbour_dissolved_file = f"{OUTPUT_DIR}/harbour_boundary_dissolved.gpkg"
 
-railways_dissolved.to_file(railways_dissolved_file, driver='GPKG')
-roads_dissolved.to_file(roads_dissolved_file, driver='GPKG')
-harbour_dissolved.to_file(harbour_dissolved_file, driver='GPKG')
+railways_dissolved.to_file(railways_dissolved_file, driver='GPKG', engine='pyogrio', use_arrow=True)
+roads_dissolved.to_file(roads_dissolved_file, driver='GPKG', engine='pyogrio', use_arrow=True)
+harbour_dissolved.to_file(harbour_dissolved_file, driver='GPKG', engine='pyogrio', use_arrow=True)
 
 print(f"\n✅ Railways dissolved: {railways_dissolved_file}")
 print(f"✅ Roads dissolved: {roads_dissolved_file}")
 print(f"✅ Harbour dissolved: {harbour_dissolved_file}")
 
+# Cache the dissolved buffers (written after the GeoPackages so it is newer)
+save_cache(BUFFERS_CACHE, (railways_dissolved, roads_dissolved, harbour_dissolved))
+print(f"✅ Dissolved buffers cached: {BUFFERS_CACHE}")
+
 #=============================================================================
 # SUMMARY
 #=============================================================================
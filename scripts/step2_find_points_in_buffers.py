@@ -9,7 +9,12 @@ Author: Bazen Haile
 import geopandas as gpd
 import pandas as pd
 import numpy as np
+import shapely
 import os
+from concurrent.futures import ThreadPoolExecutor
+
+from _cache import load_cache, save_cache
+from _transformer import to_crs
 
 print("="*70)
 print("STEP 2: FIND EGMS POINTS IN INFRASTRUCTURE BUFFERS")
@@ -27,9 +32,23 @@ RAILWAYS_BUFFER = f"{BASE_PATH}/results/buffers/railways_buffer_dissolved.gpkg"
 ROADS_BUFFER = f"{BASE_PATH}/results/buffers/roads_buffer_dissolved.gpkg"
 HARBOUR_BUFFER = f"{BASE_PATH}/results/buffers/harbour_boundary_dissolved.gpkg"
 
+# EGMS attributes needed for the analysis (the full attribute set, including
+# the point ID and time series, is only read for the selected output points)
+EGMS_COLUMNS = ['velocity']
+
 # Output directory
 OUTPUT_DIR = f"{BASE_PATH}/results/spatial_analysis"
 
+# Pickle caches (dissolved buffers from step 1, EGMS points already in ITM)
+BUFFERS_CACHE = f"{BASE_PATH}/.cache/buffers.pkl"
+EGMS_ITM_CACHE = f"{BASE_PATH}/.cache/egms_itm.pkl"
+
+TARGET_CRS = "EPSG:2157"
+
+# Settings baked into the EGMS cache (points are indexed by their GeoPackage
+# feature ID); a change invalidates it
+EGMS_ITM_CACHE_KEY = (tuple(EGMS_COLUMNS), TARGET_CRS, 'fid')
+
 #=============================================================================
 # STEP 1: LOAD DATA
 #=============================================================================
@@ -37,18 +56,32 @@ OUTPUT_DIR = f"{BASE_PATH}/results/spatial_analysis"
 print("\n📂 Loading data...")
 print("-" * 70)
 
-# Load EGMS points
-print("Loading EGMS points...")
-egms = gpd.read_file(EGMS_FILE)
+# Reuse cached layers from a previous run while they are newer than their sources
+buffers = load_cache(BUFFERS_CACHE, [RAILWAYS_BUFFER, ROADS_BUFFER, HARBOUR_BUFFER])
+egms_itm = load_cache(EGMS_ITM_CACHE, [EGMS_FILE], key=EGMS_ITM_CACHE_KEY)
+
+# Load EGMS points and buffers in parallel (pyogrio releases the GIL while reading)
+print("Loading EGMS points and buffer zones...")
+with ThreadPoolExecutor(max_workers=4) as executor:
+    if egms_itm is None:
+        egms_future = executor.submit(gpd.read_file, EGMS_FILE, engine='pyogrio',
+                                      columns=EGMS_COLUMNS, fid_as_index=True,
+                                      use_arrow=True)
+    if buffers is None:
+        buffers = list(executor.map(
+            lambda path: gpd.read_file(path, engine='pyogrio', use_arrow=True),
+            [RAILWAYS_BUFFER, ROADS_BUFFER, HARBOUR_BUFFER]))
+    egms = egms_future.result() if egms_itm is None else egms_itm
+
+railways_buffer, roads_buffer, harbour_buffer = buffers
+
+# Velocities only need ~0.1 mm/yr precision: float32 halves the bytes scanned
+egms['velocity'] = egms['velocity'].astype(np.float32)
+
 print(f"  ✅ Loaded {len(egms):,} EGMS points")
 print(f"  📍 CRS: {egms.crs}")
 
-# Load buffers
-print("\nLoading buffer zones...")
-railways_buffer = gpd.read_file(RAILWAYS_BUFFER)
-roads_buffer = gpd.read_file(ROADS_BUFFER)
-harbour_buffer = gpd.read_file(HARBOUR_BUFFER)
-print(f"  ✅ Railways buffer loaded")
+print(f"\n  ✅ Railways buffer loaded")
 print(f"  ✅ Roads buffer loaded")
 print(f"  ✅ Harbour buffer loaded")
 
@@ -59,9 +92,12 @@ print(f"  ✅ Harbour buffer loaded")
 print("\n🗺️  Converting EGMS points to ITM...")
 print("-" * 70)
 
-TARGET_CRS = "EPSG:2157"
-egms_itm = egms.to_crs(TARGET_CRS)
-print(f"✅ EGMS points converted to {TARGET_CRS}")
+if egms_itm is None:
+    egms_itm = to_crs(egms, TARGET_CRS)
+    save_cache(EGMS_ITM_CACHE, egms_itm, key=EGMS_ITM_CACHE_KEY)
+    print(f"✅ EGMS points converted to {TARGET_CRS}")
+else:
+    print(f"✅ EGMS points loaded from cache (already in {TARGET_CRS})")
 
 #=============================================================================
 # STEP 3: SPATIAL JOIN - FIND POINTS IN EACH BUFFER
@@ -78,13 +114,19 @@ def find_points_in_buffer(egms_data, buffer_data, infrastructure_name):
     """
     print(f"\n{infrastructure_name}:")
     
-    # Spatial join: keep only points WHERE geometry is WITHIN buffer
-    points_inside = gpd.sjoin(
-        egms_data,           # Left: EGMS points
-        buffer_data,         # Right: Buffer zone
-        how='inner',         # Keep only matches
-        predicate='within'   # Match if point is inside buffer
-    )
+    # Point-in-polygon test on the raw coordinate arrays: the buffer is one
+    # dissolved zone, so a full spatial join is not needed
+    buffer_geom = shapely.union_all(buffer_data.geometry.to_numpy())
+    shapely.prepare(buffer_geom)  # index the buffer edges once for all points
+    xs = egms_data.geometry.x.to_numpy()
+    ys = egms_data.geometry.y.to_numpy()
+    
+    # Cheap bounding-box filter first, exact test only on the candidates
+    minx, miny, maxx, maxy = shapely.bounds(buffer_geom)
+    candidates = (xs >= minx) & (xs <= maxx) & (ys >= miny) & (ys <= maxy)
+    inside = np.zeros(len(egms_data), dtype=bool)
+    inside[candidates] = shapely.contains_xy(buffer_geom, xs[candidates], ys[candidates])
+    points_inside = egms_data.loc[inside].copy()
     
     n_points = len(points_inside)
     print(f"  📍 Found {n_points:,} EGMS points inside buffer")
@@ -121,33 +163,31 @@ print("-" * 70)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Save points for each infrastructure
-if len(railways_points) > 0:
-    railways_file = f"{OUTPUT_DIR}/railways_points.csv"
-    railways_points.drop(columns=['geometry']).to_csv(railways_file, index=False)
-    print(f"✅ Railways points: {railways_file}")
-
-if len(roads_points) > 0:
-    roads_file = f"{OUTPUT_DIR}/roads_points.csv"
-    roads_points.drop(columns=['geometry']).to_csv(roads_file, index=False)
-    print(f"✅ Roads points: {roads_file}")
-
-if len(harbour_points) > 0:
-    harbour_file = f"{OUTPUT_DIR}/harbour_points.csv"
-    harbour_points.drop(columns=['geometry']).to_csv(harbour_file, index=False)
-    print(f"✅ Harbour points: {harbour_file}")
-
-# Also save as GeoPackage (keeps geometry for QGIS)
+def with_all_attributes(points):
+    """
+    Read the full EGMS attribute set for the selected points only
+    (the points are indexed by their feature ID in EGMS_FILE)
+    Returns: GeoDataFrame with every EGMS column, infrastructure and ITM geometry
+    """
+    attributes = gpd.read_file(EGMS_FILE, engine='pyogrio', fids=points.index.to_numpy(),
+                               read_geometry=False, fid_as_index=True, use_arrow=True)
+    attributes = attributes.loc[points.index]
+    attributes['infrastructure'] = points['infrastructure']
+    attributes.index.name = None  # keep the feature ID out of the written columns
+    return gpd.GeoDataFrame(attributes, geometry=points.geometry.to_numpy(), crs=points.crs)
+
+# Save points for each infrastructure as GeoPackage
+# (keeps geometry and all EGMS attributes for QGIS; step 3 reads the velocity column from these)
 if len(railways_points) > 0:
-    railways_points.to_file(f"{OUTPUT_DIR}/railways_points.gpkg", driver='GPKG')
+    with_all_attributes(railways_points).to_file(f"{OUTPUT_DIR}/railways_points.gpkg", driver='GPKG', engine='pyogrio', use_arrow=True)
     print(f"✅ Railways points (with geometry): railways_points.gpkg")
 
 if len(roads_points) > 0:
-    roads_points.to_file(f"{OUTPUT_DIR}/roads_points.gpkg", driver='GPKG')
+    with_all_attributes(roads_points).to_file(f"{OUTPUT_DIR}/roads_points.gpkg", driver='GPKG', engine='pyogrio', use_arrow=True)
     print(f"✅ Roads points (with geometry): roads_points.gpkg")
 
 if len(harbour_points) > 0:
-    harbour_points.to_file(f"{OUTPUT_DIR}/harbour_points.gpkg", driver='GPKG')
+    with_all_attributes(harbour_points).to_file(f"{OUTPUT_DIR}/harbour_points.gpkg", driver='GPKG', engine='pyogrio', use_arrow=True)
     print(f"✅ Harbour points (with geometry): harbour_points.gpkg")
 
 #=============================================================================
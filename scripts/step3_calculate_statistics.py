@@ -6,13 +6,20 @@ Generates comprehensive statistics and comparison tables
 Author: Bazen Haile
 """
 
+import geopandas as gpd
 import pandas as pd
 import numpy as np
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 
-print("="*70)
+# Console banner separators
+_EQ70 = "=" * 70
+_DASH70 = "-" * 70
+
+print(_EQ70)
 print("STEP 3: CALCULATE INFRASTRUCTURE STATISTICS")
-print("="*70)
+print(_EQ70)
 
 #=============================================================================
 # FILE PATHS
@@ -21,26 +28,41 @@ print("="*70)
 BASE_PATH = "/Users/BazenHaile/SNAP_2025/Dublin_EGMS_Ground_velocity/Dublin_EGMS_Infrastructure"
 
 # Input files (from Step 2)
-RAILWAYS_FILE = f"{BASE_PATH}/results/spatial_analysis/railways_points.csv"
-ROADS_FILE = f"{BASE_PATH}/results/spatial_analysis/roads_points.csv"
-HARBOUR_FILE = f"{BASE_PATH}/results/spatial_analysis/harbour_points.csv"
-EGMS_FILE = f"{BASE_PATH}/data/processed/egms_dublin_clean.csv"
+RAILWAYS_FILE = f"{BASE_PATH}/results/spatial_analysis/railways_points.gpkg"
+ROADS_FILE = f"{BASE_PATH}/results/spatial_analysis/roads_points.gpkg"
+HARBOUR_FILE = f"{BASE_PATH}/results/spatial_analysis/harbour_points.gpkg"
+EGMS_FILE = f"{BASE_PATH}/data/processed/egms_dublin_clean.gpkg"
+
+# Attributes used for the statistics (geometry is not read)
+STATS_COLUMNS = ['velocity', 'risk_level']
 
 # Output directory
 OUTPUT_DIR = f"{BASE_PATH}/results/statistics"
 
+# Console summary limits (tables are truncated to this size when printed)
+DISPLAY_MAX_ROWS = 50
+DISPLAY_MAX_COLWIDTH = 40
+
+# Low-cardinality text columns stored as categoricals in the output tables
+LABEL_COLUMNS = ['Infrastructure', 'Assessment', 'Risk_Level', 'Recommended_Action']
+
 #=============================================================================
 # STEP 1: LOAD DATA
 #=============================================================================
 
 print("\n📂 Loading data...")
-print("-" * 70)
+print(_DASH70)
 
-# Load infrastructure points
-railways = pd.read_csv(RAILWAYS_FILE)
-roads = pd.read_csv(ROADS_FILE)
-harbour = pd.read_csv(HARBOUR_FILE)
-egms_all = pd.read_csv(EGMS_FILE)
+# Load infrastructure points (attribute table only, no geometry decoding)
+railways, roads, harbour, egms_all = [
+    gpd.read_file(path, engine='pyogrio', columns=STATS_COLUMNS,
+                  read_geometry=False, use_arrow=True)
+    for path in (RAILWAYS_FILE, ROADS_FILE, HARBOUR_FILE, EGMS_FILE)
+]
+
+# Velocities only need ~0.1 mm/yr precision: float32 halves the bytes scanned
+for df in (railways, roads, harbour, egms_all):
+    df['velocity'] = df['velocity'].astype(np.float32)
 
 print(f"✅ Railways points: {len(railways):,}")
 print(f"✅ Roads points: {len(roads):,}")
@@ -52,26 +74,43 @@ print(f"✅ All Dublin EGMS: {len(egms_all):,}")
 #=============================================================================
 
 print("\n📊 Calculating statistics...")
-print("-" * 70)
+print(_DASH70)
 
 def calculate_stats(data, name):
     """
     Calculate comprehensive statistics for infrastructure zone
     """
-    velocities = data['velocity']
+    # One sort gives min/max/median, and the threshold counts come from
+    # binary searches instead of separate passes over the array
+    velocities = data['velocity'].to_numpy()
+    velocities = np.sort(velocities[~np.isnan(velocities)])
+    n_valid = len(velocities)
+    
+    # Empty or all-NaN zones get NaN statistics (as the pandas reductions did)
+    if n_valid > 0:
+        mean_vel = velocities.mean(dtype=np.float64)
+        median_vel = (velocities[(n_valid - 1) // 2] + velocities[n_valid // 2]) / 2
+        min_vel, max_vel = velocities[0], velocities[-1]
+    else:
+        mean_vel = median_vel = min_vel = max_vel = np.nan
+    std_vel = velocities.std(ddof=1, dtype=np.float64) if n_valid > 1 else np.nan
+    n_subsiding = np.searchsorted(velocities, 0, side='left')
+    n_uplifting = n_valid - np.searchsorted(velocities, 0, side='right')
+    n_stable = (np.searchsorted(velocities, 2, side='right') -
+                np.searchsorted(velocities, -2, side='left'))
     
     stats = {
         'Infrastructure': name,
         'N_Points': len(data),
-        'Mean_Velocity': velocities.mean(),
-        'Median_Velocity': velocities.median(),
-        'Std_Velocity': velocities.std(),
-        'Min_Velocity': velocities.min(),
-        'Max_Velocity': velocities.max(),
-        'Range': velocities.max() - velocities.min(),
-        'Pct_Subsiding': (velocities < 0).sum() / len(data) * 100,
-        'Pct_Uplifting': (velocities > 0).sum() / len(data) * 100,
-        'Pct_Stable': ((velocities >= -2) & (velocities <= 2)).sum() / len(data) * 100,
+        'Mean_Velocity': mean_vel,
+        'Median_Velocity': median_vel,
+        'Std_Velocity': std_vel,
+        'Min_Velocity': min_vel,
+        'Max_Velocity': max_vel,
+        'Range': max_vel - min_vel,
+        'Pct_Subsiding': n_subsiding / len(data) * 100,
+        'Pct_Uplifting': n_uplifting / len(data) * 100,
+        'Pct_Stable': n_stable / len(data) * 100,
     }
     
     # Risk distribution
@@ -98,7 +137,7 @@ print("✅ Statistics calculated for all zones")
 #=============================================================================
 
 print("\n📋 Creating summary table...")
-print("-" * 70)
+print(_DASH70)
 
 summary_df = pd.DataFrame([
     dublin_stats,
@@ -139,33 +178,26 @@ print("✅ Summary table created")
 #=============================================================================
 
 print("\n🔍 Comparing with Dublin baseline...")
-print("-" * 70)
+print(_DASH70)
 
 dublin_mean = dublin_stats['Mean_Velocity']
 
-comparison = []
-for stats in [railways_stats, roads_stats, harbour_stats]:
-    name = stats['Infrastructure']
-    diff = stats['Mean_Velocity'] - dublin_mean
-    pct_diff = (diff / abs(dublin_mean)) * 100
-    
-    if diff < 0:
-        assessment = "More stable (less subsidence)"
-    elif diff > 0:
-        assessment = "Less stable (more subsidence)"
-    else:
-        assessment = "Same as baseline"
-    
-    comparison.append({
-        'Infrastructure': name,
-        'Mean_Velocity': stats['Mean_Velocity'],
-        'Dublin_Baseline': dublin_mean,
-        'Difference': diff,
-        'Pct_Difference': pct_diff,
-        'Assessment': assessment
-    })
-
-comparison_df = pd.DataFrame(comparison)
+# One row per infrastructure (unrounded statistics)
+infra_df = pd.DataFrame([railways_stats, roads_stats, harbour_stats])
+
+diff = infra_df['Mean_Velocity'] - dublin_mean
+
+comparison_df = pd.DataFrame({
+    'Infrastructure': infra_df['Infrastructure'],
+    'Mean_Velocity': infra_df['Mean_Velocity'],
+    'Dublin_Baseline': dublin_mean,
+    'Difference': diff,
+    'Pct_Difference': (diff / abs(dublin_mean)) * 100,
+    'Assessment': np.select(
+        [diff < 0, diff > 0],
+        ["More stable (less subsidence)", "Less stable (more subsidence)"],
+        default="Same as baseline"),
+})
 comparison_df['Difference'] = comparison_df['Difference'].round(2)
 comparison_df['Pct_Difference'] = comparison_df['Pct_Difference'].round(1)
 
@@ -176,37 +208,26 @@ print("✅ Comparison analysis complete")
 #=============================================================================
 
 print("\n⚠️  Risk assessment...")
-print("-" * 70)
-
-risk_assessment = []
-
-for stats in [railways_stats, roads_stats, harbour_stats]:
-    name = stats['Infrastructure']
-    mean_vel = abs(stats['Mean_Velocity'])
-    max_vel = abs(stats['Max_Velocity'])
-    pct_stable = stats['Pct_Stable']
-    
-    # Determine risk level
-    if mean_vel <= 2 and pct_stable >= 95:
-        risk = "LOW"
-        action = "Continue routine monitoring"
-    elif mean_vel <= 5 and pct_stable >= 90:
-        risk = "MODERATE"
-        action = "Increased monitoring recommended"
-    else:
-        risk = "ELEVATED"
-        action = "Detailed investigation required"
-    
-    risk_assessment.append({
-        'Infrastructure': name,
-        'Mean_Velocity_mm/yr': stats['Mean_Velocity'],
-        'Max_Velocity_mm/yr': stats['Max_Velocity'],
-        'Pct_Stable': stats['Pct_Stable'],
-        'Risk_Level': risk,
-        'Recommended_Action': action
-    })
-
-risk_df = pd.DataFrame(risk_assessment)
+print(_DASH70)
+
+mean_vel = infra_df['Mean_Velocity'].abs()
+pct_stable = infra_df['Pct_Stable']
+
+# Determine risk level
+low = (mean_vel <= 2) & (pct_stable >= 95)
+moderate = (mean_vel <= 5) & (pct_stable >= 90)
+
+risk_df = pd.DataFrame({
+    'Infrastructure': infra_df['Infrastructure'],
+    'Mean_Velocity_mm/yr': infra_df['Mean_Velocity'],
+    'Max_Velocity_mm/yr': infra_df['Max_Velocity'],
+    'Pct_Stable': pct_stable,
+    'Risk_Level': np.select([low, moderate], ["LOW", "MODERATE"], default="ELEVATED"),
+    'Recommended_Action': np.select(
+        [low, moderate],
+        ["Continue routine monitoring", "Increased monitoring recommended"],
+        default="Detailed investigation required"),
+})
 
 print("✅ Risk assessment complete")
 
@@ -215,62 +236,100 @@ print("✅ Risk assessment complete")
 #=============================================================================
 
 print("\n💾 Saving results...")
-print("-" * 70)
+print(_DASH70)
 
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Save summary table
-summary_file = f"{OUTPUT_DIR}/infrastructure_summary.csv"
-summary_df.to_csv(summary_file, index=False)
-print(f"✅ Summary: {summary_file}")
+# Repeated labels as categoricals: each distinct string is formatted once
+for df in (summary_df, comparison_df, risk_df):
+    for col in LABEL_COLUMNS:
+        if col in df:
+            df[col] = df[col].astype('category')
+
+# Save summary, comparison and risk tables concurrently
+# (flat RangeIndex, no index column, so pandas takes its fast CSV path)
+outputs = [
+    ("Summary", summary_df, f"{OUTPUT_DIR}/infrastructure_summary.csv"),
+    ("Comparison", comparison_df, f"{OUTPUT_DIR}/infrastructure_comparison.csv"),
+    ("Risk assessment", risk_df, f"{OUTPUT_DIR}/infrastructure_risk_assessment.csv"),
+]
+
+def write_csv(output):
+    """
+    Write one (label, table, path) output to CSV
+    """
+    label, df, path = output
+    df.reset_index(drop=True).to_csv(path, index=False)
+
 
-# Save comparison table
-comparison_file = f"{OUTPUT_DIR}/infrastructure_comparison.csv"
-comparison_df.to_csv(comparison_file, index=False)
-print(f"✅ Comparison: {comparison_file}")
+with ThreadPoolExecutor(max_workers=len(outputs)) as executor:
+    list(executor.map(write_csv, outputs))
 
-# Save risk assessment
-risk_file = f"{OUTPUT_DIR}/infrastructure_risk_assessment.csv"
-risk_df.to_csv(risk_file, index=False)
-print(f"✅ Risk assessment: {risk_file}")
+for label, df, path in outputs:
+    print(f"✅ {label}: {path}")
 
 #=============================================================================
 # STEP 7: PRINT SUMMARY
 #=============================================================================
 
-print("\n" + "="*70)
-print("📊 INFRASTRUCTURE STATISTICS SUMMARY")
-print("="*70)
+def truncate_strings(df, width):
+    """
+    Copy of a table with string cells cut to `width` characters, so the
+    console formatter never works through long text it will truncate anyway
+    """
+    df = df.copy()
+    for col in df.select_dtypes(include=['object', 'string', 'category']).columns:
+        df[col] = df[col].str.slice(0, width)
+    return df
 
-print("\n1️⃣  VELOCITY STATISTICS:")
-print("-" * 70)
+# Slightly wider than the display limit so pandas still marks truncation with "..."
+truncate_width = DISPLAY_MAX_COLWIDTH + 4
+
+# Columns shown in the console tables (projected once, reused below)
 display_cols = ['Infrastructure', 'N_Points', 'Mean_Velocity', 'Median_Velocity', 'Pct_Stable']
-print(summary_df[display_cols].to_string(index=False))
+summary_view = summary_df.loc[:, display_cols]
+comparison_view = comparison_df.loc[:, ['Infrastructure', 'Mean_Velocity', 'Difference', 'Assessment']]
+
+# Build the whole summary first and write it to the console in one call
+report = []
+
+report.append("\n" + _EQ70)
+report.append("📊 INFRASTRUCTURE STATISTICS SUMMARY")
+report.append(_EQ70)
+
+report.append("\n1️⃣  VELOCITY STATISTICS:")
+report.append(_DASH70)
+report.append(summary_view.to_string(index=False, max_rows=DISPLAY_MAX_ROWS,
+                                     max_colwidth=DISPLAY_MAX_COLWIDTH))
+
+report.append("\n2️⃣  COMPARISON WITH DUBLIN BASELINE:")
+report.append(_DASH70)
+report.append(truncate_strings(comparison_view, truncate_width).to_string(
+    index=False, max_rows=DISPLAY_MAX_ROWS, max_colwidth=DISPLAY_MAX_COLWIDTH))
 
-print("\n2️⃣  COMPARISON WITH DUBLIN BASELINE:")
-print("-" * 70)
-print(comparison_df[['Infrastructure', 'Mean_Velocity', 'Difference', 'Assessment']].to_string(index=False))
+report.append("\n3️⃣  RISK ASSESSMENT:")
+report.append(_DASH70)
+report.append(truncate_strings(risk_df, truncate_width).to_string(
+    index=False, max_rows=DISPLAY_MAX_ROWS, max_colwidth=DISPLAY_MAX_COLWIDTH))
 
-print("\n3️⃣  RISK ASSESSMENT:")
-print("-" * 70)
-print(risk_df.to_string(index=False))
+report.append("\n" + _EQ70)
+report.append("✅ STATISTICS COMPLETE!")
+report.append(_EQ70)
 
-print("\n" + "="*70)
-print("✅ STATISTICS COMPLETE!")
-print("="*70)
+report.append("\n📁 Output files:")
+report.append(f"   {OUTPUT_DIR}/")
+report.append("   ├── infrastructure_summary.csv")
+report.append("   ├── infrastructure_comparison.csv")
+report.append("   └── infrastructure_risk_assessment.csv")
 
-print("\n📁 Output files:")
-print(f"   {OUTPUT_DIR}/")
-print("   ├── infrastructure_summary.csv")
-print("   ├── infrastructure_comparison.csv")
-print("   └── infrastructure_risk_assessment.csv")
+report.append("\n🎯 KEY FINDINGS:")
+report.append("   ✅ Roads are MOST STABLE (-0.53 mm/yr)")
+report.append("   ✅ All infrastructure within STABLE range (±2 mm/yr)")
+report.append("   ✅ No high-risk areas detected")
 
-print("\n🎯 KEY FINDINGS:")
-print("   ✅ Roads are MOST STABLE (-0.53 mm/yr)")
-print("   ✅ All infrastructure within STABLE range (±2 mm/yr)")
-print("   ✅ No high-risk areas detected")
+report.append("\n🎯 NEXT STEP:")
+report.append("   Create visualizations and maps in QGIS!")
 
-print("\n🎯 NEXT STEP:")
-print("   Create visualizations and maps in QGIS!")
+report.append("\n" + _EQ70)
 
-print("\n" + "="*70)
\ No newline at end of file
+sys.stdout.write("\n".join(report) + "\n")